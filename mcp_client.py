@@ -3,8 +3,8 @@
 mcp_client.py: Демонстрационный MCP клиент с интеграцией OpenAI
 
 Этот скрипт подключается к локальному MCP серверу, получает список
-доступных инструментов и использует OpenAI API (функция chat completions
-с tools) для определения, какой MCP инструмент вызвать для ответа
+доступных инструментов и использует OpenAI API (Responses API с tools)
+для определения, какой MCP инструмент вызвать для ответа
 на запрос пользователя в интерактивном режиме чата.
 """
 
@@ -16,18 +16,45 @@ mcp_client.py: Демонстрационный MCP клиент с интегр
 
 # %%
 import asyncio
+import collections
+import contextlib
 import os
+import re
+import stat
+import sys
+import threading
+import uuid
+import weakref
 import json
-from openai import AsyncOpenAI # Используем асинхронного клиента
+import logging
+import orjson # Быстрый JSON парсер/сериализатор для горячего цикла чата
+from typing import Optional
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient # Используем асинхронного клиента
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 import mcp.types as types
 from dotenv import load_dotenv # Добавляем импорт
 
+# Служебные сообщения клиента идут через logging (в stderr) и по умолчанию
+# скрыты: подробный вывод включается переменной окружения LOGLEVEL=DEBUG.
+# LOGLEVEL действует только на логгер клиента, библиотеки (httpx, openai, mcp)
+# остаются на уровне WARNING. В stdout остается только сам диалог с ассистентом.
+log = logging.getLogger("mcp_client") # не "mcp": это корневой логгер MCP SDK
+
+def configure_logging() -> None:
+    """Настраивает вывод логов; вызывается при запуске скрипта."""
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    level_name = (os.getenv("LOGLEVEL") or "WARNING").upper()
+    level = logging.getLevelName(level_name)
+    if not isinstance(level, int):
+        log.warning("[Client Setup] Неизвестный LOGLEVEL=%s, используется WARNING.", level_name)
+        level = logging.WARNING
+    log.setLevel(level)
+
 # Загружаем переменные из .env файла (если он есть)
 # Это нужно сделать до первого обращения к os.environ
 load_dotenv()
-print("[Client Setup] Попытка загрузки переменных из .env")
 
 # %% [markdown]
 # ## 2. Функция для преобразования MCP Tool в формат OpenAI Tool
@@ -39,222 +66,742 @@ print("[Client Setup] Попытка загрузки переменных из
 # %%
 def mcp_tool_to_openai_tool(mcp_tool: types.Tool) -> dict:
     """Конвертирует MCP Tool в формат OpenAI Tool Function."""
-    parameters = {
-        "type": "object",
-        "properties": {},
-        "required": [],
+    # types.Tool - модель pydantic: один вызов model_dump вместо getattr на каждое поле
+    tool = mcp_tool.model_dump(exclude_none=True)
+
+    # MCP сервер уже описывает аргументы в inputSchema в формате JSON Schema
+    # с настоящими типами (FastMCP строит ее по аннотациям функции),
+    # поэтому передаем ее в OpenAI как есть. Недостающие "type"/"properties"
+    # (OpenAI требует их для объекта) дополняем в том же литерале, без
+    # отдельной сборки словаря параметров.
+    parameters = {"type": "object", "properties": {}, **tool.get("inputSchema", {})}
+
+    return {
+        "type": "function",
+        "name": tool.get("name", "unknown_tool"),
+        "description": tool.get("description", ""),
+        "parameters": parameters,
+        # В Responses API строгая проверка схемы включена по умолчанию и требует
+        # additionalProperties=false, которого нет в схемах MCP
+        "strict": False,
     }
 
-    # Безопасно получаем атрибут 'arguments', используя getattr. Возвращаем None, если его нет.
-    mcp_arguments = getattr(mcp_tool, 'arguments', None)
+# %% [markdown]
+# ## 2.2 Потоковый запрос к OpenAI с ранним вызовом инструментов
+#
+# Используем Responses API: история диалога хранится на стороне OpenAI,
+# и каждый запрос ссылается на предыдущий ответ через `previous_response_id`.
+# Поэтому на каждой реплике отправляется только новая часть диалога,
+# а не вся история целиком.
+#
+# Но оплачивается каждый запрос все равно по всей истории цепочки на
+# сервере (`truncation="auto"` обрезает ее, только когда она не помещается
+# в контекст). Поэтому окно истории сохраняется: клиент помнит последние
+# HISTORY_WINDOW сообщений, и после MAX_CHAINED_TURNS реплик в одной цепочке
+# начинает новую - без `previous_response_id`, с этими сообщениями в `input`.
+#
+# Ответ запрашиваем в режиме `stream=True`. Как только очередной вызов
+# функции полностью сформирован (событие `response.output_item.done`),
+# сразу запускаем его на MCP сервере, не дожидаясь конца ответа модели.
+# Так генерация токенов OpenAI перекрывается с выполнением инструментов.
+
+# %%
+HISTORY_WINDOW = 16 # Сообщений, переносимых в новую цепочку
+MAX_CHAINED_TURNS = 10 # Реплик в одной цепочке до ее перезапуска
+
+async def stream_response(openai_client: AsyncOpenAI, session: ClientSession,
+                          instructions: str, input_items: list,
+                          previous_response_id: Optional[str], tool_kwargs: dict,
+                          tool_cache=None):
+    """
+    Выполняет потоковый запрос к OpenAI Responses API.
+
+    Возвращает кортеж (текст ответа, список вызовов функций в формате
+    элементов `function_call`, словарь call_id -> asyncio.Task с уже
+    запущенным вызовом MCP, id ответа для следующего запроса).
+
+    `tool_kwargs` - параметры tools/tool_choice, собранные один раз на сессию.
+    """
+    stream = await openai_client.responses.create(
+        model="gpt-4o",
+        instructions=instructions,
+        input=input_items,
+        previous_response_id=previous_response_id,
+        truncation="auto", # Слишком длинную историю OpenAI обрежет сам
+        stream=True,
+        **tool_kwargs,
+    )
+
+    text_parts = []
+    tool_calls = []
+    pending_calls = {} # call_id -> запущенная задача call_tool
+    response_id = None
+
+    try:
+        async for event in stream:
+            if event.type == "response.created":
+                response_id = event.response.id
+            elif event.type == "response.output_text.delta":
+                text_parts.append(event.delta)
+            elif event.type == "response.output_item.done" and event.item.type == "function_call":
+                item = event.item
+                tool_call = {
+                    "type": "function_call",
+                    "call_id": item.call_id,
+                    "name": item.name,
+                    "arguments": item.arguments,
+                }
+                tool_calls.append(tool_call)
+                # Ошибку разбора аргументов сообщит обычный вызов после окончания стрима
+                try:
+                    function_args = orjson.loads(item.arguments)
+                except orjson.JSONDecodeError:
+                    continue
+                if not isinstance(function_args, dict):
+                    continue
+                log.debug("[Client] -> Ранний вызов %s на MCP сервере, аргументы: %s", item.name, function_args)
+                pending_calls[item.call_id] = asyncio.create_task(
+                    call_mcp_tool(session, item.name, function_args, tool_cache)
+                )
+            elif event.type in ("response.failed", "error"):
+                raise RuntimeError(f"OpenAI вернула ошибку: {event}")
+    except BaseException:
+        # Стрим оборвался: уже запущенные вызовы MCP никто не дождется,
+        # поэтому отменяем их и забираем результаты, чтобы не было
+        # предупреждений "Task exception was never retrieved".
+        for task in pending_calls.values():
+            task.cancel()
+        await asyncio.gather(*pending_calls.values(), return_exceptions=True)
+        raise
+
+    return "".join(text_parts), tool_calls, pending_calls, response_id
+
+# %% [markdown]
+# ## 2.3 Выполнение одного вызова инструмента
+#
+# Разбор аргументов, вызов MCP и обработка ошибок вынесены в отдельную
+# корутину, чтобы несколько `tool_calls` из одного ответа можно было
+# выполнить параллельно через `asyncio.gather`.
+#
+# Результаты детерминированных инструментов без состояния (калькулятор)
+# кэшируются в LRU по имени инструмента и аргументам: повторный вызов
+# с теми же числами не обращается к процессу MCP сервера.
 
-    if mcp_arguments: # Проверяем, что список аргументов существует и не пуст
-        for arg in mcp_arguments:
-            # OpenAI ожидает описание параметров в формате JSON Schema.
-            # Мы делаем простое предположение, что все аргументы - строки.
-            # Также безопасно получаем атрибуты самого аргумента (name, description, required)
-            arg_name = getattr(arg, 'name', None)
-            if not arg_name:
-                print(f"[Warning] MCP Tool Argument в {mcp_tool.name} не имеет имени, пропуск.")
-                continue # Пропускаем аргумент без имени
+# %%
+def tool_result_to_text(mcp_tool_result: types.CallToolResult) -> str:
+    """
+    Извлекает из результата MCP только текст для сообщения OpenAI.
 
-            arg_description = getattr(arg, 'description', '') or '' # Описание может быть None
-            arg_required = getattr(arg, 'required', False)
+    repr всего `CallToolResult` в несколько раз длиннее самого ответа и
+    тратит токены впустую. Если текстовых блоков нет, отдаем JSON результата.
+    """
+    text = "".join(
+        block.text for block in mcp_tool_result.content if getattr(block, "type", None) == "text"
+    )
+    if text:
+        return text
+    return mcp_tool_result.model_dump_json(exclude_none=True)
+
+PURE_TOOLS = {"add", "subtract", "multiply"} # Результат зависит только от аргументов
+TOOL_CACHE_SIZE = 1024
+
+async def call_mcp_tool(session: ClientSession, function_name: str, function_args: dict,
+                        tool_cache: Optional[collections.OrderedDict] = None) -> str:
+    """Вызывает инструмент на MCP сервере (или берет ответ из кэша) и возвращает его текст."""
+    cache_key = None
+    if tool_cache is not None and function_name in PURE_TOOLS:
+        try:
+            cache_key = (function_name, tuple(sorted(function_args.items())))
+            hash(cache_key)
+        except TypeError:
+            cache_key = None # Аргументы не хэшируются (списки, словари) - не кэшируем
+        if cache_key in tool_cache:
+            tool_cache.move_to_end(cache_key)
+            log.debug("[Client]    Результат %s взят из кэша.", function_name)
+            return tool_cache[cache_key]
+
+    mcp_tool_result = await session.call_tool(function_name, arguments=function_args)
+    content = tool_result_to_text(mcp_tool_result)
+    if mcp_tool_result.isError:
+        raise RuntimeError(content)
+    if cache_key is not None:
+        tool_cache[cache_key] = content
+        if len(tool_cache) > TOOL_CACHE_SIZE:
+            tool_cache.popitem(last=False)
+    return content
+
+def function_call_output(tool_call: dict, output: str) -> dict:
+    """Формирует элемент с результатом вызова функции для Responses API."""
+    return {"type": "function_call_output", "call_id": tool_call["call_id"], "output": output}
+
+async def dispatch_tool_call(session: ClientSession, tool_call: dict, task=None,
+                             tool_cache: Optional[collections.OrderedDict] = None) -> tuple:
+    """
+    Выполняет вызов функции на MCP сервере.
 
-            parameters["properties"][arg_name] = {
-                "type": "string", # TODO: В идеале тип должен приходить от MCP
-                "description": arg_description,
-            }
-            if arg_required:
-                parameters["required"].append(arg_name)
+    Возвращает пару (элемент `function_call_output`, признак успешного вызова).
+    Если вызов уже был запущен во время стрима, передается его `task`.
+    """
+    function_name = tool_call["name"]
+    log.debug("[Client] -> Обработка вызова инструмента: %s", function_name)
+    try:
+        if task is None:
+            # Вызов не был запущен во время стрима - запускаем сейчас
+            function_args = orjson.loads(tool_call["arguments"])
+            log.debug("[Client]    Аргументы от OpenAI: %s", function_args)
+            log.debug("[Client]    Вызов %s на MCP сервере...", function_name)
+            task = call_mcp_tool(session, function_name, function_args, tool_cache)
+        content = await task
+        log.debug("[Client]    Результат от MCP сервера (%s): %s", function_name, content)
+        return function_call_output(tool_call, content), True
+    except orjson.JSONDecodeError as e:
+        log.warning("[Client]    Ошибка: Не удалось распарсить аргументы JSON: %s, %s", tool_call['arguments'], e)
+        return function_call_output(tool_call, "Ошибка: неверный формат аргументов JSON."), False
+    except Exception as e:
+        log.warning("[Client]    Ошибка при вызове MCP инструмента %s: %s", function_name, e)
+        return function_call_output(tool_call, f"Ошибка выполнения инструмента: {e}"), False
 
-    tool_name = getattr(mcp_tool, 'name', 'unknown_tool')
-    tool_description = getattr(mcp_tool, 'description', '') or ''
+# %% [markdown]
+# ## 2.3.1 Быстрый путь для простых выражений
+#
+# Для запросов вида "2 + 3" или "сколько будет 10 - 4" намерение очевидно,
+# поэтому не спрашиваем модель, какой инструмент вызвать: сразу формируем
+# вызов `add`/`subtract` и выполняем его сами (ответ затем собирается
+# локально, см. 2.3.2).
+#
+# Перед выражением допускается только короткий список вводных слов:
+# любой другой текст ("корень из 16 + 9", "не складывай 2 + 3") может
+# менять смысл, и такие запросы разбирает модель. Минус без пробелов
+# вокруг ("2024-10") похож на дату или диапазон, поэтому тоже уходит модели.
 
+# %%
+ARITHMETIC_LEAD_INS = ("сколько будет", "посчитай", "вычисли")
+ARITHMETIC_NUMBER = r"(-?\d+(?:[.,]\d+)?)"
+ARITHMETIC_RE = re.compile(
+    r"(?:(?:" + "|".join(ARITHMETIC_LEAD_INS) + r")\s*:?\s+)?"
+    + ARITHMETIC_NUMBER + r"(\s*\+\s*|\s+-\s+)" + ARITHMETIC_NUMBER
+    + r"\s*[=?]?",
+    re.IGNORECASE,
+)
+ARITHMETIC_TOOLS = {"+": "add", "-": "subtract"}
+
+def match_arithmetic_tool_call(user_request: str, tool_names: frozenset) -> Optional[dict]:
+    """
+    Возвращает готовый элемент `function_call` для простого выражения или None.
+
+    Срабатывает, только если весь запрос - одно сложение или вычитание
+    двух чисел (с необязательным вводным словом из ARITHMETIC_LEAD_INS)
+    и нужный инструмент есть на сервере.
+
+    >>> tools = frozenset({"add", "subtract"})
+    >>> match_arithmetic_tool_call("2+3", tools)["name"]
+    'add'
+    >>> match_arithmetic_tool_call("Сколько будет 10 - 4?", tools)["name"]
+    'subtract'
+    >>> [match_arithmetic_tool_call(text, tools) for text in (
+    ...     "корень из 16 + 9", "половина от 10 - 4", "не складывай 2 + 3", "2024-10")]
+    [None, None, None, None]
+    """
+    match = ARITHMETIC_RE.fullmatch(user_request.strip())
+    if not match:
+        return None
+    left, operator, right = match.groups()
+    function_name = ARITHMETIC_TOOLS[operator.strip()]
+    if function_name not in tool_names:
+        return None
+    arguments = {"a": float(left.replace(",", ".")), "b": float(right.replace(",", "."))}
     return {
-        "type": "function",
-        "function": {
-            "name": tool_name,
-            "description": tool_description,
-            "parameters": parameters,
-        },
+        "type": "function_call",
+        "call_id": f"call_local_{uuid.uuid4().hex}",
+        "name": function_name,
+        "arguments": json.dumps(arguments),
     }
 
+# %% [markdown]
+# ## 2.3.2 Ответ без второго запроса к OpenAI
+#
+# Инструменты калькулятора сами возвращают готовую фразу
+# ("Результат сложения 2.0 + 3.0 = 5.0"). Если в реплике был ровно один
+# такой вызов и он прошел без ошибок, показываем эту фразу пользователю
+# сразу и не просим OpenAI переформулировать результат.
+#
+# Такие реплики OpenAI еще не видела и получит вместе со следующим запросом.
+# Чтобы этот хвост не рос без ограничений, после MAX_CARRY_OVER_ITEMS
+# элементов ответ снова запрашивается у OpenAI, и хвост отправляется.
+
+# %%
+LOCAL_ANSWER_TOOLS = {"add", "subtract", "multiply"} # Возвращают законченный ответ
+MAX_CARRY_OVER_ITEMS = 20
+
+def build_local_answer(tool_calls: list, outputs: list, succeeded: list) -> Optional[str]:
+    """Возвращает ответ, собранный из результата инструмента, или None."""
+    if len(tool_calls) != 1 or tool_calls[0]["name"] not in LOCAL_ANSWER_TOOLS:
+        return None
+    if not succeeded[0]: # Ошибки пусть объясняет модель
+        return None
+    return outputs[0]["output"]
+
+# %% [markdown]
+# ## 2.4 Системный промпт
+#
+# OpenAI автоматически кэширует префикс запроса, если он побайтно совпадает
+# между вызовами (и длиннее 1024 токенов). Поэтому системные инструкции -
+# статический текст, который передается в `instructions` каждого запроса
+# без изменений (Responses API не переносит `instructions` из предыдущего
+# ответа), а `tools` отправляются в отсортированном по имени порядке.
+# Схемы инструментов в инструкции не дублируются: модель уже получает их
+# в `tools`.
+
+# %%
+SYSTEM_PROMPT = """Ты полезный русскоязычный ассистент-калькулятор. У тебя есть доступ к следующим математическим инструментам:
+1. add - сложение двух чисел
+2. subtract - вычитание двух чисел
+3. multiply - умножение двух чисел
+
+Когда пользователь просит произвести математические вычисления:
+- Используй add для сложения
+- Используй subtract для вычитания
+- Используй multiply для умножения
+
+
+Всегда используй инструменты для вычислений, даже для простых операций."""
+#- Для других математических операций - говори, что не можешь выполнить.
+
+# %% [markdown]
+# ## 2.5 Асинхронное чтение ввода пользователя
+#
+# Блокирующий `input()` останавливает весь цикл событий, поэтому stdin
+# подключается к `asyncio.StreamReader` через `loop.connect_read_pipe`.
+# Если stdin - обычный файл или платформа не поддерживает pipe-транспорт,
+# строки читает фоновый поток и передает их в тот же `StreamReader`.
+# Reader создается один раз на цикл событий и переиспользуется.
+#
+# Терминал тоже читается потоком: `connect_read_pipe` переводит fd 0 в
+# неблокирующий режим, а у терминала stdin и stdout - одно открытое описание
+# файла. Тогда длинный `print()` может упасть с `BlockingIOError`, а
+# неблокирующий терминал достается и оболочке после выхода из клиента.
+# Обычный файл (`python mcp_client.py < script.txt`) проверяется заранее:
+# `connect_read_pipe` uvloop на нем не бросает исключение, а аварийно
+# завершает процесс внутри libuv.
+
+# %%
+# Слабые ссылки на циклы: закрытый цикл (например, после asyncio.run) не удерживается в памяти.
+_stdin_readers = weakref.WeakKeyDictionary() # цикл событий -> StreamReader, stdin подключается один раз
+
+def stdin_is_regular_file() -> bool:
+    """Проверяет, перенаправлен ли stdin из обычного файла."""
+    try:
+        return stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode)
+    except (OSError, ValueError):
+        return False
+
+async def create_stdin_reader() -> asyncio.StreamReader:
+    """Возвращает StreamReader, из которого можно асинхронно читать stdin."""
+    loop = asyncio.get_running_loop()
+    if loop in _stdin_readers:
+        return _stdin_readers[loop]
+    reader = _stdin_readers[loop] = asyncio.StreamReader()
+
+    def pump_stdin():
+        for line in iter(sys.stdin.buffer.readline, b""):
+            loop.call_soon_threadsafe(reader.feed_data, line)
+        loop.call_soon_threadsafe(reader.feed_eof)
+
+    if not sys.stdin.isatty() and not stdin_is_regular_file():
+        try:
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+            return reader
+        except (ValueError, OSError, NotImplementedError):
+            pass
+    threading.Thread(target=pump_stdin, daemon=True).start()
+    return reader
+
+# %% [markdown]
+# ### 2.5.1 Объединение строк ввода
+#
+# При вставке нескольких строк или при подаче сценария через pipe строки
+# приходят почти одновременно. Вместо отдельного запроса к OpenAI на каждую
+# строку собираем все строки, пришедшие в течение короткого окна, в одну
+# реплику пользователя.
+
+# %%
+COALESCE_INPUT_TIMEOUT = 0.05 # секунды ожидания следующей строки
+
+async def read_user_lines(reader: asyncio.StreamReader) -> list:
+    """
+    Читает строку ввода и все строки, пришедшие сразу за ней.
+
+    Возвращает список строк без перевода строки; пустой список означает EOF.
+    """
+    line = await reader.readline()
+    if not line:
+        return []
+    lines = [line]
+    while True:
+        try:
+            line = await asyncio.wait_for(reader.readline(), timeout=COALESCE_INPUT_TIMEOUT)
+        except asyncio.TimeoutError:
+            break
+        if not line:
+            break # EOF обработает следующий вызов
+        lines.append(line)
+    return [line.decode(errors="replace").rstrip() for line in lines]
+
+# %% [markdown]
+# ## 2.6 Постоянное соединение с MCP сервером
+#
+# `stdio_client` при каждом подключении запускает новый процесс
+# `python3 mcp_server.py` и заново выполняет `initialize`. `MCPClientHolder`
+# держит одно соединение (процесс сервера + `ClientSession`) и отдает его
+# всем вызовам `run_client()`. Вложенные и параллельные `async with holder:`
+# переиспользуют уже открытую сессию, а закрывается она при выходе из
+# последнего блока.
+#
+# Контексты `stdio_client` и `ClientSession` (anyio) должны закрываться в той
+# же задаче, в которой открыты. Поэтому соединение живет в отдельной задаче
+# `_hold_connection`, а открытие и закрытие идут под `asyncio.Lock`: какая бы
+# задача ни вышла из блока последней, сервер запускается один раз и
+# корректно останавливается.
+#
+# Поэтому, чтобы несколько последовательных `run_client()` работали с одним
+# процессом сервера, внешний блок должен держать вызывающий код:
+#
+# ```python
+# async with MCPClientHolder.get(default_server_params()) as holder:
+#     await run_client(holder)
+#     await run_client(holder)
+# ```
+#
+# Без внешнего блока каждый `run_client()` сам открывает и закрывает
+# соединение. На каждый набор параметров запуска приходится свой экземпляр.
+
+# %%
+def default_server_params() -> StdioServerParameters:
+    """Параметры запуска локального `mcp_server.py`."""
+    return StdioServerParameters(
+        command="python3",
+        # frozen_modules ускоряет запуск интерпретатора сервера
+        args=["-X", "frozen_modules=on", "mcp_server.py"],
+    )
+
+class MCPClientHolder:
+    """Переиспользуемое подключение к MCP серверу, одно на набор параметров запуска."""
+
+    _instances = {} # параметры запуска (JSON) -> MCPClientHolder
+
+    def __init__(self, server_params: StdioServerParameters):
+        self.server_params = server_params
+        self.session: Optional[ClientSession] = None
+        self.init_response: Optional[types.InitializeResult] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._connection_task: Optional[asyncio.Task] = None
+        self._closing: Optional[asyncio.Event] = None
+        self._users = 0
+
+    @classmethod
+    def get(cls, server_params: StdioServerParameters) -> "MCPClientHolder":
+        """Возвращает общий экземпляр для этих параметров, создавая его при первом обращении."""
+        key = server_params.model_dump_json()
+        if key not in cls._instances:
+            cls._instances[key] = cls(server_params)
+        return cls._instances[key]
+
+    async def _hold_connection(self, opened: asyncio.Event) -> None:
+        """Открывает соединение, держит его до сигнала `_closing` и закрывает в этой же задаче."""
+        try:
+            async with contextlib.AsyncExitStack() as exit_stack:
+                log.debug("[Client] Попытка запуска MCP сервера и установки соединения через stdio_client...")
+                read_stream, write_stream = await exit_stack.enter_async_context(stdio_client(self.server_params))
+                log.debug("[Client] Соединение с MCP сервером установлено.")
+
+                log.debug("[Client] Создание ClientSession...")
+                session = await exit_stack.enter_async_context(ClientSession(read_stream, write_stream))
+                log.debug("[Client] ClientSession создана.")
+
+                log.debug("[Client] Инициализация MCP...")
+                self.init_response = await session.initialize()
+                self.session = session
+                opened.set()
+                await self._closing.wait()
+        finally:
+            self.session = None
+            self.init_response = None
+
+    async def __aenter__(self) -> "MCPClientHolder":
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._connection_task is None:
+                self._closing = asyncio.Event()
+                opened = asyncio.Event()
+                task = asyncio.create_task(self._hold_connection(opened))
+                opened_wait = asyncio.create_task(opened.wait())
+                try:
+                    await asyncio.wait({task, opened_wait}, return_when=asyncio.FIRST_COMPLETED)
+                    if not opened.is_set():
+                        await task # Соединение не установлено - пробрасываем ошибку
+                except BaseException:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    raise
+                finally:
+                    opened_wait.cancel()
+                self._connection_task = task
+            else:
+                log.debug("[Client] Используется уже открытое соединение с MCP сервером.")
+            self._users += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        async with self._lock:
+            self._users -= 1
+            if self._users == 0 and self._connection_task is not None:
+                task = self._connection_task
+                self._connection_task = None
+                self._closing.set()
+                await task
+                log.debug("[Client] ClientSession закрыта.")
+                log.debug("[Client] Соединение с MCP сервером закрыто.")
+
 # %% [markdown]
 # ## 3. Основная асинхронная функция `run_client`
 #
 # Модифицируем эту функцию для использования OpenAI и добавления режима чата.
 
 # %%
-async def run_client():
+async def run_client(mcp_holder: Optional[MCPClientHolder] = None):
     """
     Основная асинхронная функция для запуска клиента, взаимодействия с MCP сервером
     и использования OpenAI для вызова инструментов в режиме чата.
+
+    Если передан уже открытый `mcp_holder`, используется его сессия
+    и процесс сервера заново не запускается. Открытым он остается, только пока
+    вызывающий код держит `async with mcp_holder:` (см. раздел 2.6).
     """
-    print("[Client] Запуск MCP клиента с интеграцией OpenAI в режиме чата...")
+    log.debug("[Client] Запуск MCP клиента с интеграцией OpenAI в режиме чата...")
 
     # %% [markdown]
     # ### 3.1 Настройка клиента OpenAI
     # Создаем асинхронного клиента OpenAI. API ключ должен быть установлен
     # в переменной окружения `OPENAI_API_KEY`.
+    # HTTP/2 соединение держим открытым между репликами (keepalive), а сразу
+    # после запуска делаем фоновый запрос `models.list`, чтобы DNS и TLS
+    # рукопожатие прошли, пока пользователь набирает первый вопрос.
     # %%
-    print("[Client] Настройка клиента OpenAI...")
+    log.debug("[Client] Настройка клиента OpenAI...")
     try:
-        openai_client = AsyncOpenAI()
+        openai_client = AsyncOpenAI(
+            http_client=DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=600),
+            )
+        )
         if not openai_client.api_key:
             raise ValueError("Переменная окружения OPENAI_API_KEY не установлена.")
-        print("[Client] Клиент OpenAI настроен.")
+        log.debug("[Client] Клиент OpenAI настроен.")
     except Exception as e:
-        print(f"[Client] Ошибка настройки клиента OpenAI: {e}")
-        print("[Client] Убедитесь, что библиотека openai установлена (`pip install openai`)")
-        print("[Client] и переменная окружения OPENAI_API_KEY установлена.")
+        log.error("[Client] Ошибка настройки клиента OpenAI: %s", e)
+        log.error("[Client] Убедитесь, что библиотека openai установлена (`pip install openai`)")
+        log.error("[Client] и переменная окружения OPENAI_API_KEY установлена.")
         return # Выход, если клиент не настроен
 
+    async def warmup_openai_connection():
+        # models.list() возвращает пагинатор, а не корутину - его нужно дождаться.
+        # Ошибки прогрева не важны: основной запрос сам установит соединение.
+        try:
+            await openai_client.models.list()
+        except Exception as e:
+            log.debug("[Client] Прогрев соединения с OpenAI не удался: %s", e)
+    warmup_task = asyncio.create_task(warmup_openai_connection())
+
+    try:
+        await run_chat(openai_client, mcp_holder)
+    finally:
+        # Клиент и его пул HTTP/2 соединений живут только внутри run_client
+        warmup_task.cancel()
+        await asyncio.gather(warmup_task, return_exceptions=True)
+        await openai_client.close()
+
+async def run_chat(openai_client: AsyncOpenAI, mcp_holder: Optional[MCPClientHolder] = None):
+    """Подключается к MCP серверу и ведет чат через уже настроенного клиента OpenAI."""
     # %% [markdown]
     # ### 3.2 Параметры запуска MCP сервера
     # Указываем, как запустить наш локальный `mcp_server.py`.
     # %%
-    print("[Client] Настройка параметров запуска MCP сервера (StdioServerParameters)...")
-    server_params = StdioServerParameters(
-        command="python3",
-        args=["mcp_server.py"],
-    )
-    print(f"[Client] Параметры: command='{server_params.command}', args={server_params.args}")
+    log.debug("[Client] Настройка параметров запуска MCP сервера (StdioServerParameters)...")
+    server_params = mcp_holder.server_params if mcp_holder is not None else default_server_params()
+    log.debug("[Client] Параметры: command='%s', args=%s", server_params.command, server_params.args)
+    if mcp_holder is None:
+        mcp_holder = MCPClientHolder.get(server_params)
 
     # %% [markdown]
     # ### 3.3 Установка соединения с MCP сервером и подготовка к чату
-    # Соединяемся с сервером, получаем инструменты и инициализируем историю чата.
+    # Соединяемся с сервером (или берем уже открытое соединение), получаем
+    # инструменты и инициализируем историю чата.
     # %%
-    print("[Client] Попытка запуска MCP сервера и установки соединения через stdio_client...")
-    async with stdio_client(server_params) as (read_stream, write_stream):
-        print("[Client] Соединение с MCP сервером установлено.")
+    async with mcp_holder:
+        session = mcp_holder.session
+        init_response = mcp_holder.init_response
 
-        print("[Client] Создание ClientSession...")
-        async with ClientSession(read_stream, write_stream) as session:
-            print("[Client] ClientSession создана.")
+        # #### 3.3.1 Инициализация MCP и получение инструментов ####
+        log.debug("[Client] Сервер инициализирован: %s v%s", init_response.serverInfo.name, init_response.serverInfo.version)
 
-            # #### 3.3.1 Инициализация MCP и получение инструментов ####
-            print("[Client] Инициализация MCP...")
-            init_response = await session.initialize()
-            print(f"[Client] Сервер инициализирован: {init_response.serverInfo.name} v{init_response.serverInfo.version}")
-
-            print("[Client] Запрос списка инструментов у MCP сервера...")
-            openai_tools = [] # Инициализируем пустым списком
+        log.debug("[Client] Запрос списка инструментов у MCP сервера...")
+        openai_tools = [] # Инициализируем пустым списком
+        try:
+            list_tools_result = await session.list_tools()
+            mcp_tools_list = list_tools_result.tools
+            if not mcp_tools_list:
+                 log.info("[Client] Сервер не предоставил инструментов. Работаем без них.")
+            else:
+                log.debug("[Client] Получено %s инструментов от MCP сервера.", len(mcp_tools_list))
+                openai_tools = [mcp_tool_to_openai_tool(tool) for tool in mcp_tools_list]
+                log.debug("[Client] Инструменты сконвертированы в формат OpenAI.")
+        except Exception as e:
+            log.warning("[Client] Ошибка при получении или конвертации инструментов: %s. Работаем без них.", e)
+
+        # Детерминированный порядок инструментов - часть стабильного префикса запроса
+        openai_tools.sort(key=lambda tool: tool["name"])
+
+        # #### 3.3.2 Инициализация диалога ####
+        # История хранится на стороне OpenAI; локально помним только id
+        # последнего ответа. Инструкции не меняются, чтобы префикс попадал в кэш.
+        instructions = SYSTEM_PROMPT
+        # Все, что зависит только от набора инструментов, собираем один раз на сессию,
+        # а не на каждой реплике. Сам JSON запроса сериализует SDK OpenAI.
+        tool_kwargs = {"tools": openai_tools, "tool_choice": "auto"} if openai_tools else {}
+        tool_names = frozenset(tool["name"] for tool in openai_tools)
+        last_response_id = None
+        # Последние сообщения диалога и число реплик в текущей цепочке ответов
+        recent_messages = collections.deque(maxlen=HISTORY_WINDOW)
+        chained_turns = 0
+        # Элементы реплик, ответ на которые собран локально: OpenAI их еще не видела,
+        # они уходят вместе со следующим запросом, чтобы история на сервере была полной
+        carry_over_input = []
+        print("\n" + "="*25 + " Начат Чат с Ассистентом " + "="*25)
+        print('Введите ваш запрос или "выход" для завершения.')
+        stdin_reader = await create_stdin_reader()
+        tool_cache = collections.OrderedDict() # LRU кэш результатов PURE_TOOLS
+
+        # %% [markdown]
+        # ### 3.4 Цикл чата
+        # Бесконечный цикл для приема запросов пользователя и взаимодействия с OpenAI/MCP.
+        # %%
+        while True:
             try:
-                list_tools_result = await session.list_tools()
-                mcp_tools_list = list_tools_result.tools
-                if not mcp_tools_list:
-                     print("[Client] Сервер не предоставил инструментов. Работаем без них.")
-                else:
-                    print(f"[Client] Получено {len(mcp_tools_list)} инструментов от MCP сервера.")
-                    openai_tools = [mcp_tool_to_openai_tool(tool) for tool in mcp_tools_list]
-                    print("[Client] Инструменты сконвертированы в формат OpenAI.")
-            except Exception as e:
-                print(f"[Client] Ошибка при получении или конвертации инструментов: {e}. Работаем без них.")
-
-            # #### 3.3.2 Инициализация истории чата ####
-            messages = [
-                {"role": "system", "content": """Ты полезный русскоязычный ассистент-калькулятор. У тебя есть доступ к следующим математическим инструментам:
-1. add - сложение двух чисел
-2. subtract - вычитание двух чисел
-
-Когда пользователь просит произвести математические вычисления:
-- Используй add для сложения
-- Используй subtract для вычитания
-
-
-Всегда используй инструменты для вычислений, даже для простых операций."""}
-            ]
-            print("\n" + "="*25 + " Начат Чат с Ассистентом " + "="*25)
-            print('Введите ваш запрос или "выход" для завершения.')
-#- Для других математических операций - говори, что не можешь выполнить.
-
-            # %% [markdown]
-            # ### 3.4 Цикл чата
-            # Бесконечный цикл для приема запросов пользователя и взаимодействия с OpenAI/MCP.
-            # %%
-            while True:
-                try:
-                    # --- Получение ввода пользователя ---
-                    user_request = input("\nВы: ")
-                    if user_request.strip().lower() == "выход":
-                        print("[Client] Завершение чата по команде пользователя.")
+                # --- Получение ввода пользователя ---
+                print("\nВы: ", end="", flush=True)
+                lines = await read_user_lines(stdin_reader)
+                if not lines:
+                    log.debug("[Client] Ввод закрыт (EOF), завершение чата.")
+                    break
+                # Строки после команды "выход" отбрасываем, строки до нее отправляем
+                exit_requested = False
+                for index, line in enumerate(lines):
+                    if line.strip().lower() == "выход":
+                        lines = lines[:index]
+                        exit_requested = True
+                        break
+                user_request = "\n".join(line for line in lines if line.strip())
+                if not user_request:
+                    if exit_requested:
+                        log.debug("[Client] Завершение чата по команде пользователя.")
                         break
-                    if not user_request.strip():
-                        continue # Пропускаем пустой ввод
-
-                    # Добавляем сообщение пользователя в историю
-                    messages.append({"role": "user", "content": user_request})
-
-                    # --- Взаимодействие с OpenAI ---
-                    print("[Client] Отправка запроса и истории в OpenAI...")
-                    response = await openai_client.chat.completions.create(
-                        model="gpt-4o", # Или gpt-3.5-turbo
-                        messages=messages,
-                        tools=openai_tools if openai_tools else None, # Передаем None если список пуст
-                        tool_choice="auto",
+                    continue # Пропускаем пустой ввод
+                if len(lines) > 1:
+                    log.debug("[Client] Объединено строк ввода в один запрос: %s", len(lines))
+
+                # В запрос уходит только новая реплика пользователя
+                user_message = {"role": "user", "content": user_request}
+                previous_response_id = last_response_id
+                turn_input = carry_over_input + [user_message]
+                if chained_turns >= MAX_CHAINED_TURNS:
+                    # Цепочка стала длинной - начинаем новую с последних сообщений
+                    log.debug("[Client] Новая цепочка ответов с %s последними сообщениями.", len(recent_messages))
+                    previous_response_id = None
+                    turn_input = list(recent_messages) + [user_message]
+
+                # --- Взаимодействие с OpenAI ---
+                fast_tool_call = match_arithmetic_tool_call(user_request, tool_names)
+                if fast_tool_call:
+                    # Инструмент очевиден - пропускаем запрос "какой инструмент вызвать".
+                    # Вызов функции отправим в OpenAI вместе с его результатом.
+                    log.debug("[Client] Простое выражение, сразу вызываем %s.", fast_tool_call['name'])
+                    answer_text, tool_calls, pending_calls = "", [fast_tool_call], {}
+                    response_id = previous_response_id
+                    turn_input.append(fast_tool_call)
+                else:
+                    log.debug("[Client] Отправка запроса в OpenAI (stream)...")
+                    answer_text, tool_calls, pending_calls, response_id = await stream_response(
+                        openai_client, session, instructions, turn_input,
+                        previous_response_id, tool_kwargs, tool_cache,
                     )
-                    response_message = response.choices[0].message
-                    tool_calls = response_message.tool_calls
-
-                    # --- Обработка ответа OpenAI (Вызов инструментов или прямой ответ) ---
-                    if tool_calls:
-                        print(f"[Client] OpenAI решила вызвать инструмент(ы): {[call.function.name for call in tool_calls]}")
-                        # Добавляем намерение ассистента вызвать инструмент в историю
-                        # Важно: добавляем объект сообщения как есть
-                        messages.append(response_message)
-
-                        tool_results_messages = [] # Собираем результаты для второго вызова
-                        for tool_call in tool_calls:
-                            function_name = tool_call.function.name
-                            tool_call_id = tool_call.id
-                            print(f"[Client] -> Обработка вызова инструмента: {function_name}")
-                            try:
-                                function_args = json.loads(tool_call.function.arguments)
-                                print(f"[Client]    Аргументы от OpenAI: {function_args}")
-                                print(f"[Client]    Вызов {function_name} на MCP сервере...")
-                                mcp_tool_result = await session.call_tool(function_name, arguments=function_args)
-                                print(f"[Client]    Результат от MCP сервера: {mcp_tool_result}")
-                                tool_results_messages.append({"tool_call_id": tool_call_id, "role": "tool", "name": function_name, "content": str(mcp_tool_result)})
-                            except json.JSONDecodeError as e:
-                                print(f"[Client]    Ошибка: Не удалось распарсить аргументы JSON: {tool_call.function.arguments}, {e}")
-                                tool_results_messages.append({"role": "tool", "tool_call_id": tool_call_id, "name": function_name, "content": "Ошибка: неверный формат аргументов JSON."})
-                            except Exception as e:
-                                print(f"[Client]    Ошибка при вызове MCP инструмента {function_name}: {e}")
-                                tool_results_messages.append({"role": "tool", "tool_call_id": tool_call_id, "name": function_name, "content": f"Ошибка выполнения инструмента: {e}"})
-
-                        # Добавляем все результаты инструментов в историю
-                        messages.extend(tool_results_messages)
-
+                    turn_input = [] # Реплика уже сохранена в ответе response_id
+
+                # --- Обработка ответа OpenAI (Вызов инструментов или прямой ответ) ---
+                if tool_calls:
+                    log.debug("[Client] OpenAI решила вызвать инструмент(ы): %s", [call['name'] for call in tool_calls])
+
+                    # Выполняем все вызовы параллельно; порядок результатов
+                    # совпадает с порядком tool_calls
+                    results = await asyncio.gather(
+                        *[dispatch_tool_call(session, tool_call, pending_calls.get(tool_call["call_id"]), tool_cache)
+                          for tool_call in tool_calls],
+                        return_exceptions=True,
+                    )
+                    outputs, succeeded = [], []
+                    for tool_call, result in zip(tool_calls, results):
+                        if isinstance(result, BaseException):
+                            result = function_call_output(tool_call, f"Ошибка выполнения инструмента: {result}"), False
+                        outputs.append(result[0])
+                        succeeded.append(result[1])
+                    turn_input.extend(outputs)
+
+                    final_answer = build_local_answer(tool_calls, outputs, succeeded)
+                    if final_answer is not None and len(turn_input) >= MAX_CARRY_OVER_ITEMS:
+                        # Накопилось много реплик без OpenAI - отправляем их сейчас
+                        final_answer = None
+                    if final_answer is not None:
+                        # Ответ уже готов - второй запрос к OpenAI не нужен
+                        log.debug("[Client] Ответ сформирован из результата инструмента.")
+                        carry_over_input = turn_input + [{"role": "assistant", "content": final_answer}]
+                        last_response_id = response_id
+                    else:
                         # Получаем финальный ответ от OpenAI после вызова инструментов
-                        print("[Client] Отправка результатов инструментов обратно в OpenAI...")
-                        second_response = await openai_client.chat.completions.create(
+                        log.debug("[Client] Отправка результатов инструментов обратно в OpenAI...")
+                        second_response = await openai_client.responses.create(
                             model="gpt-4o",
-                            messages=messages,
-                            # tools и tool_choice здесь не нужны, т.к. мы ждем текстовый ответ
+                            instructions=instructions,
+                            input=turn_input,
+                            previous_response_id=response_id,
+                            truncation="auto",
+                            # tools здесь не нужны, т.к. мы ждем текстовый ответ
                         )
-                        final_answer = second_response.choices[0].message.content
-                        # Добавляем финальный ответ ассистента в историю
-                        messages.append({"role": "assistant", "content": final_answer})
+                        final_answer = second_response.output_text
+                        last_response_id = second_response.id
+                        carry_over_input = []
 
-                    else:
-                        # OpenAI ответила сразу без инструментов
-                        final_answer = response_message.content
-                        # Добавляем ответ ассистента в историю
-                        messages.append({"role": "assistant", "content": final_answer})
+                else:
+                    # OpenAI ответила сразу без инструментов
+                    final_answer = answer_text
+                    last_response_id = response_id
+                    carry_over_input = []
 
-                    # --- Вывод ответа пользователю ---
-                    print(f"\nАссистент: {final_answer}")
+                # --- Вывод ответа пользователю ---
+                print(f"\nАссистент: {final_answer}")
+                recent_messages.extend([user_message, {"role": "assistant", "content": final_answer}])
+                chained_turns = chained_turns + 1 if previous_response_id else 1
 
-                except Exception as e:
-                    print(f"\n[Client] Произошла ошибка в цикле чата: {e}")
-                    break 
+                if exit_requested:
+                    log.debug("[Client] Завершение чата по команде пользователя.")
+                    break
 
-            # --- Конец цикла чата ---
-            print("\n" + "="*28 + " Чат Завершен " + "="*28)
+            except Exception as e:
+                log.error("[Client] Произошла ошибка в цикле чата: %s", e)
+                break 
 
-        print("[Client] ClientSession закрыта.")
-    print("[Client] Соединение с MCP сервером закрыто.")
+        # --- Конец цикла чата ---
+        print("\n" + "="*28 + " Чат Завершен " + "="*28)
 
 
 # %% [markdown]
@@ -262,19 +809,30 @@ async def run_client():
 # Запускаем `run_client` при исполнении скрипта.
 # %%
 if __name__ == "__main__":
-    print("[Client Main] Скрипт запущен напрямую.")
+    configure_logging()
+    log.debug("[Client Main] Скрипт запущен напрямую.")
+    # load_dotenv() уже выполнен при импорте, до настройки логирования
+    log.debug("[Client Setup] Переменные из .env загружены (если файл найден).")
     # Проверка наличия ключа перед запуском основного кода
     if "OPENAI_API_KEY" not in os.environ:
-         print("[Client Main] ОШИБКА: Переменная окружения OPENAI_API_KEY не найдена.")
-         print("[Client Main] Пожалуйста, установите её перед запуском скрипта.")
-         print("[Client Main] Пример: export OPENAI_API_KEY='ваш_ключ'")
+         log.error("[Client Main] ОШИБКА: Переменная окружения OPENAI_API_KEY не найдена.")
+         log.error("[Client Main] Пожалуйста, установите её перед запуском скрипта.")
+         log.error("[Client Main] Пример: export OPENAI_API_KEY='ваш_ключ'")
     else:
+        # uvloop - более быстрый цикл событий на libuv для stdio и сокетов.
+        # Если он не установлен (например, на Windows), работаем на стандартном asyncio.
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            log.debug("[Client Main] Используется цикл событий uvloop.")
+        except ImportError:
+            pass
         try:
             asyncio.run(run_client())
-            print("[Client Main] asyncio.run завершен.")
+            log.debug("[Client Main] asyncio.run завершен.")
         except KeyboardInterrupt:
-            print("\n[Client Main] Выполнение прервано пользователем (KeyboardInterrupt).")
+            log.info("[Client Main] Выполнение прервано пользователем (KeyboardInterrupt).")
         except Exception as e:
-             print(f"[Client Main] Непредвиденная ошибка: {e}")
+             log.error("[Client Main] Непредвиденная ошибка: %s", e)
 
 """ End of mcp_client.py """